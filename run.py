@@ -1,32 +1,57 @@
 #!/usr/bin/env python3
 
+import array
+import atexit
 import hashlib
 import os
+import signal
 import struct
 import sys
-
+import time
+
+try:
+    # CPython's own SHA-256 skips OpenSSL's per-object EVP setup, which is
+    # most of the cost when hashing just 32 bytes.
+    from _sha2 import sha256 as _small_sha256  # CPython 3.12+
+except ImportError:
+    try:
+        from _sha256 import sha256 as _small_sha256  # CPython up to 3.11
+    except ImportError:
+        _small_sha256 = hashlib.sha256
 
 PAGE_SIZE = 256 // 4  # digest_size / bits_per_instruction
 SEED_HASH_ITERATIONS = 2_000_000
 PAGE_NUMBER_FORMAT = '<Q'  # Little endian unsigned 64-bit
+PAGE_NUMBER_STRUCT = struct.Struct(PAGE_NUMBER_FORMAT)
 RESTRICTION_ENV_VAR = b'JUDECCA_RUN_NOLIMIT'
 RESTRICTION_MAXPAGE = 2**20
 RESTRICTION_MAXTAPE = 2**20
+INITIAL_TAPE_SIZE = 2**16
+PAGE_CACHE_SIZE = 64  # Pages kept around, in order of generation
+IO_BUFFER_SIZE = 4096
+IO_FLUSH_DELAY = 0.1  # Seconds that output may stay buffered, roughly
+IO_FLUSH_CHECK_INTERVAL = 2**14  # Handlers run between checks for stale output
 DEBUG_JUDECCA = False
 
 
 def compute_seed(source_code):
-    seed = source_code
-    for _ in range(SEED_HASH_ITERATIONS):
-        seed = hashlib.sha256(seed).digest()
+    seed = hashlib.sha256(source_code).digest()
+    sha256 = _small_sha256
+    for _ in range(SEED_HASH_ITERATIONS - 1):
+        seed = sha256(seed).digest()
     # E.g. the hexstring bca503b85f…
     return seed
 
 
-def get_page(source_code, seed, page_number):
-    page_num_bytes = struct.pack(PAGE_NUMBER_FORMAT, page_number)
+def get_page(source_code, seed, page_number, seed_hash=None):
+    # `seed_hash` may be a prepared `hashlib.sha256(seed)`, which saves
+    # absorbing the seed again for every page.
+    page_num_bytes = PAGE_NUMBER_STRUCT.pack(page_number)
 
-    h = hashlib.sha256(seed)
+    if seed_hash is None:
+        h = hashlib.sha256(seed)
+    else:
+        h = seed_hash.copy()
     h.update(page_num_bytes)
     h.update(source_code)
     page_pre = h.digest()
@@ -39,18 +64,18 @@ def get_page(source_code, seed, page_number):
     return page  # E.g., the hexstring 315f5bdb…
 
 
+NIBBLE_TABLE = bytes.maketrans(b'0123456789abcdef', bytes(range(16)))
+PRETTY_TABLE = bytes.maketrans(bytes(range(16)), b'+-<>[].,$|%_____')
+
+
 def as_instructions(page):
-    # Silly, but totally sufficient.
-    return page.hex().upper()
+    # One instruction (0 to 15) per nibble, high nibble first.
+    # Going through hex() keeps the whole conversion in C.
+    return page.hex().encode().translate(NIBBLE_TABLE)
 
 
 def prettify_instructions(insns, strip=True):
-    substitutions = [('0', '+'), ('1', '-'), ('2', '<'), ('3', '>'),
-                     ('4', '['), ('5', ']'), ('6', '.'), ('7', ','),
-                     ('8', '$'), ('9', '|'), ('A', '%'), ('B', '_'),
-                     ('C', '_'), ('D', '_'), ('E', '_'), ('F', '_')]
-    for (old, new) in substitutions:
-        insns = insns.replace(old, new)
+    insns = insns.translate(PRETTY_TABLE).decode()
     if strip:
         insns = insns.replace('_', '')
         insns = insns.replace('%', '')
@@ -58,33 +83,108 @@ def prettify_instructions(insns, strip=True):
     return insns
 
 
+class CompiledPage:
+    def __init__(self, insns):
+        self.insns = insns
+        # What to call for each offset.  Straight-line code (no jumps, no
+        # I/O) starts out as op_compile, which replaces itself on first use.
+        self.handlers = [DISPATCH_TABLE[insn] for insn in insns]
+        self.block_lengths = [1] * len(insns)
+        self.block_args = [None] * len(insns)
+
+    def compile_block(self, offset):
+        # Sums up the straight-line code starting at `offset` into one
+        # handler.  Blocks never cross the page boundary.
+        insns = self.insns
+        end = offset
+        cells = dict()  # Relative to the head at the start of the block
+        head = low = 0
+        while end < len(insns) and DISPATCH_TABLE[insns[end]] is op_compile:
+            insn = insns[end]
+            if insn <= 1:  # '+-'
+                cells[head] = cells.get(head, 0) + (1 if insn == 0 else -1)
+            elif insn <= 3:  # '<>' (both move the head the same way)
+                head -= 1
+                low = min(low, head)
+            end += 1
+        cell_deltas = tuple((rel, delta & 0xFF) for (rel, delta) in cells.items() if delta & 0xFF)
+        if not cell_deltas and head == 0:
+            handler = op_nop
+            arg = None
+        elif not cell_deltas:
+            handler = op_move
+            arg = head
+        elif head == 0 and len(cell_deltas) == 1 and cell_deltas[0][0] == 0:
+            handler = op_add
+            arg = cell_deltas[0][1]
+        else:
+            handler = op_block
+            arg = (cell_deltas, head, low)
+        self.handlers[offset] = handler
+        self.block_lengths[offset] = end - offset
+        self.block_args[offset] = arg
+
+
 class PageCache:
     def __init__(self, source_code, seed, nolimit=False):
         self.source_code = source_code
         self.seed = seed
+        self.seed_hash = hashlib.sha256(seed)
         self.ip = 0
         self.nolimit = nolimit
         self.latest_page_num = None
-        self.latest_instructions = 'INSTRUCTIONS_GO_HERE'
+        self.latest_page = CompiledPage(b'')
+        # The JumpTable scans ahead, and loops jump back across page
+        # boundaries, so a single slot would keep evicting the page that
+        # is actually being executed.
+        self.pages = dict()
 
-    def get_instructions(self, page_num):
+    def get_compiled_page(self, page_num):
         if self.latest_page_num != page_num:
-            if not self.nolimit and page_num > RESTRICTION_MAXPAGE:
-                print('Limit exceeded: tried to access page {}'.format(page_num),
-                      file=sys.stderr)
-                exit(2)
+            compiled_page = self.pages.get(page_num)
+            if compiled_page is None:
+                if not self.nolimit and page_num > RESTRICTION_MAXPAGE:
+                    print('Limit exceeded: tried to access page {}'.format(page_num),
+                          file=sys.stderr)
+                    exit(2)
+                page = get_page(self.source_code, self.seed, page_num, self.seed_hash)
+                compiled_page = CompiledPage(as_instructions(page))
+                if len(self.pages) >= PAGE_CACHE_SIZE:
+                    del self.pages[next(iter(self.pages))]
+                self.pages[page_num] = compiled_page
             self.latest_page_num = page_num
-            page = get_page(self.source_code, self.seed, page_num)
-            self.latest_instructions = as_instructions(page)
-        return self.latest_instructions
+            self.latest_page = compiled_page
+        return self.latest_page
+
+    def get_instructions(self, page_num):
+        return self.get_compiled_page(page_num).insns
+
+
+CLEAR_LOOP_INSNS = bytes([0, 1, 10, 11, 12, 13, 14, 15])  # '+-%_____'
+
+
+def is_clear_loop_body(body):
+    # Only '+', '-' and no-ops, changing the cell by an odd amount per
+    # iteration: Whatever the cell holds, the loop ends with it at zero.
+    # A body that moves the head never comes back to its cell, because
+    # '<' and '>' move the same way.
+    if body.translate(None, CLEAR_LOOP_INSNS):
+        return False
+    return (body.count(0) - body.count(1)) % 2 == 1
+
+
+# Translation table that keeps '[]|' and turns everything else into 0.
+JUMP_INSNS_TABLE = bytes(insn if insn in (4, 5, 9) else 0 for insn in range(256))
 
 
 class JumpTable:
     def __init__(self, page_cache):
         self.page_cache = page_cache
         self.progress_maxpage = -1
-        self.progress_open = []
-        self.mapping = dict()  # TODO: Can be done more efficiently!
+        self.progress_open = array.array('q')
+        # Indexed by instruction number; only brackets have meaningful entries.
+        self.mapping = array.array('q')
+        self.clear_loops = set()  # Positions of '[' that start a clear loop
 
     def get_jump_dest(self, insn_num, is_head_zero):
         insn_page_num = insn_num // PAGE_SIZE
@@ -127,23 +227,26 @@ class JumpTable:
         self.progress_maxpage += 1
         insn_page = self.page_cache.get_instructions(self.progress_maxpage)
         frame = self.progress_maxpage * PAGE_SIZE
-        for (offset, insn) in enumerate(insn_page):
-            if insn == '9':  # '|' (simplify)
-                if bool(self.progress_open):
-                    insn = '5'  # ']'
-                else:
-                    insn = '4'  # '['
-            if insn == '4':  # '['
-                self.progress_open.append(frame + offset + 1)
-                self.mapping[frame + offset] = -1
-            elif insn == '5' and bool(self.progress_open):  # ']' (matched)
-                dest = self.progress_open.pop()
-                self.mapping[frame + offset] = dest
-                assert self.mapping[dest - 1] == -1
-                self.mapping[dest - 1] = frame + offset + 1
-            elif insn == '5':  # ']' (unmatched)
-                assert not bool(self.progress_open)
-                self.mapping[frame + offset] = 0
+        mapping = self.mapping
+        progress_open = self.progress_open
+        mapping.frombytes(bytes(mapping.itemsize * PAGE_SIZE))
+        insn_num = frame
+        for insn in insn_page.translate(JUMP_INSNS_TABLE):
+            if not insn:
+                pass
+            elif insn == 4 or (insn == 9 and not progress_open):  # '[' (or '|' simplified)
+                progress_open.append(insn_num + 1)
+                mapping[insn_num] = -1
+            elif progress_open:  # ']' (or '|' simplified, matched)
+                dest = progress_open.pop()
+                mapping[insn_num] = dest
+                assert mapping[dest - 1] == -1
+                mapping[dest - 1] = insn_num + 1
+                if dest >= frame and is_clear_loop_body(insn_page[dest - frame:insn_num - frame]):
+                    self.clear_loops.add(dest - 1)
+            else:  # ']' (unmatched)
+                mapping[insn_num] = 0
+            insn_num += 1
 
 
 def judecca_debugging_break():
@@ -154,6 +257,7 @@ class IODev:
     def write_byte(self, the_byte):
         '''
         Given a bytestring of length 1, output that byte.
+        The bytestring may be reused by the caller afterwards.
         '''
         raise NotImplementedError()
 
@@ -164,17 +268,57 @@ class IODev:
         '''
         raise NotImplementedError()
 
+    def flush(self):
+        '''
+        Outputs all bytes that have been written so far, if buffered.
+        '''
+        raise NotImplementedError()
+
+    def flush_if_stale(self):
+        '''
+        Called regularly during execution.  Outputs buffered bytes if they
+        have been waiting for too long.
+        '''
+        raise NotImplementedError()
+
 
 class DefaultIODev:
+    def __init__(self):
+        # Output is flushed on newline, when the buffer is full, before
+        # reading, when it has been pending for IO_FLUSH_DELAY, and on exit.
+        # Input is read ahead in blocks.
+        self.out_buf = bytearray()
+        self.out_since = None  # When out_buf last became non-empty
+        self.in_buf = b''
+        self.in_pos = 0
+        atexit.register(self.flush)
+
     def write_byte(self, the_byte):
-        written = os.write(1, the_byte)
-        assert written == 1
+        if not self.out_buf:
+            self.out_since = time.monotonic()
+        self.out_buf += the_byte
+        if the_byte == b'\n' or len(self.out_buf) >= IO_BUFFER_SIZE:
+            self.flush()
 
     def read_byte(self):
-        the_bytes = os.read(0, 1)
-        assert len(the_bytes) <= 1
+        self.flush()
+        if self.in_pos >= len(self.in_buf):
+            self.in_buf = os.read(0, IO_BUFFER_SIZE)
+            self.in_pos = 0
+        # Slices of length 1 are cached by CPython, so this doesn't allocate.
+        the_bytes = self.in_buf[self.in_pos:self.in_pos + 1]
+        self.in_pos += len(the_bytes)
         return the_bytes
 
+    def flush(self):
+        while self.out_buf:
+            written = os.write(1, self.out_buf)
+            del self.out_buf[:written]
+
+    def flush_if_stale(self):
+        if self.out_buf and time.monotonic() - self.out_since >= IO_FLUSH_DELAY:
+            self.flush()
+
 
 class DummyIODev:
     def write_byte(self, the_byte):
@@ -183,14 +327,105 @@ class DummyIODev:
     def read_byte(self):
         return b'?'
 
+    def flush(self):
+        pass
+
+    def flush_if_stale(self):
+        pass
+
+
+def op_jump(m, page, offset):  # '[]|'
+    is_head_zero = m.tape[m.head] == 0
+    if not is_head_zero and m.ip in m.jump_table.clear_loops:
+        # Skip all iterations, see is_clear_loop_body().
+        m.tape[m.head] = 0
+        m.ip = m.jump_table.mapping[m.ip]
+        return
+    m.ip = m.jump_table.get_jump_dest(m.ip, is_head_zero)
+
+
+def op_compile(m, page, offset):  # '+-<>%_____'
+    page.compile_block(offset)
+    page.handlers[offset](m, page, offset)
+
+
+# The remaining handlers each execute one block of straight-line code,
+# see CompiledPage.compile_block().
+
+def op_nop(m, page, offset):
+    m.ip += page.block_lengths[offset]
+
+
+def op_add(m, page, offset):
+    tape = m.tape
+    head = m.head
+    tape[head] = (tape[head] + page.block_args[offset]) & 0xFF
+    m.ip += page.block_lengths[offset]
+
+
+def op_move(m, page, offset):
+    head = m.head + page.block_args[offset]
+    if not 0 <= head < len(m.tape):
+        head = m.grow_tape(head)
+    m.head = head
+    m.ip += page.block_lengths[offset]
+
+
+def op_block(m, page, offset):
+    (cell_deltas, move, low) = page.block_args[offset]
+    head = m.head
+    if head + low < 0:
+        # The head only ever moves down, so this is the only end to check.
+        head = m.grow_tape(head + low) - low
+    tape = m.tape
+    for (rel, delta) in cell_deltas:
+        tape[head + rel] = (tape[head + rel] + delta) & 0xFF
+    m.head = head + move
+    m.ip += page.block_lengths[offset]
+
+
+def op_write(m, page, offset):  # '.'
+    if DEBUG_JUDECCA:
+        print('out', m.tape[m.head:m.head + 1])
+    out_byte = m.out_byte
+    out_byte[0] = m.tape[m.head]
+    m.iodev.write_byte(out_byte)
+    m.ip += 1
+
+
+def op_read(m, page, offset):  # ','
+    the_bytes = m.iodev.read_byte()
+    if DEBUG_JUDECCA:
+        print('in', the_bytes)
+    if len(the_bytes) == 1:
+        m.tape[m.head] = the_bytes[0]
+    elif len(the_bytes) == 0:
+        m.tape[m.head] = 0
+    else:
+        raise AssertionError('Tried to read 1 byte, read {} instead?!'.format(len(the_bytes)))
+    m.ip += 1
+
+
+def op_debug(m, page, offset):  # '$'
+    judecca_debugging_break()
+    m.ip += 1
+
+
+# Indexed by instruction, see prettify_instructions().
+DISPATCH_TABLE = [op_compile, op_compile, op_compile, op_compile,
+                  op_jump, op_jump, op_write, op_read,
+                  op_debug, op_jump, op_compile, op_compile,
+                  op_compile, op_compile, op_compile, op_compile]
+
 
 class Machine:
     def __init__(self, source_code, seed, nolimit=False, iodev=None):
         self.ip = 0
         self.nolimit = nolimit
-        self.tape_before = bytearray(1)
-        self.tape_after_rev = bytearray(1)
-        # Invariant: Both lists are non-empty.
+        self.tape = bytearray(INITIAL_TAPE_SIZE)
+        self.head = INITIAL_TAPE_SIZE // 2
+        self.origin = self.head  # Index of the cell the head started on
+        self.out_byte = bytearray(1)  # Reused for every '.'
         self.page_cache = PageCache(source_code, seed, nolimit)
         self.jump_table = JumpTable(self.page_cache)
         if iodev is None:
@@ -200,65 +435,73 @@ class Machine:
                 iodev = DefaultIODev()
         self.iodev = iodev
 
-    def step(self):
-        page_num = self.ip // PAGE_SIZE
-        insn_page = self.page_cache.get_instructions(page_num)
-        insn = insn_page[self.ip % PAGE_SIZE]
-        if insn in '459':  # '[]|'
-            is_head_zero = self.tape_after_rev[-1] == 0
-            self.ip = self.jump_table.get_jump_dest(self.ip, is_head_zero)
-            return
-        if insn in 'ABCDEF':  # '%_____'
-            pass
-        elif insn in '01':  # '+-'
-            newval = self.tape_after_rev[-1] + 2 * (insn == '0') - 1
-            self.tape_after_rev[-1] = newval & 0xFF
-        elif insn in '23':  # '<>'
-            if insn == '2':
-                mv_from = self.tape_before
-                mv_to = self.tape_after_rev
-            else:
-                mv_from = self.tape_before
-                mv_to = self.tape_after_rev
-            mv_to.append(mv_from.pop())
-            if not bool(mv_from):
-                if not self.nolimit and len(mv_from) >= RESTRICTION_MAXTAPE:
-                    print('Limit exceeded: tried to extend to {}'.format(len(mv_from) + 1),
-                          file=sys.stderr)
-                    exit(2)
-                mv_from.append(0)
-        elif insn == '6':  # '.'
-            if DEBUG_JUDECCA:
-                print('out', self.tape_after_rev[-1:])
-            self.iodev.write_byte(self.tape_after_rev[-1:])
-        elif insn == '7':  # ','
-            the_bytes = self.iodev.read_byte()
-            if DEBUG_JUDECCA:
-                print('in', the_bytes)
-            if len(the_bytes) == 1:
-                self.tape_after_rev[-1] = the_bytes[0]
-            elif len(the_bytes) == 0:
-                # Recall: Invariant: Both sides of the tape are non-empty.
-                self.tape_after_rev[-1] = 0
-            else:
-                raise AssertionError('Tried to read 1 byte, read {} instead?!'.format(len(the_bytes)))
-        elif insn == '8':  # '$'
-            judecca_debugging_break()
-        else:
-            raise AssertionError('Illegal instruction encountered?! "{}"'.format(insn))
+    def grow_tape(self, head):
+        # Makes room for a head that has left the buffer, and returns its
+        # new index.  Without nolimit, the buffer never extends beyond
+        # RESTRICTION_MAXTAPE cells away from the origin.
+        position = head - self.origin
+        if not self.nolimit and abs(position) > RESTRICTION_MAXTAPE:
+            print('Limit exceeded: tried to move to cell {}'.format(position),
+                  file=sys.stderr)
+            exit(2)
+        if head < 0:
+            grow = max(len(self.tape), -head)
+            if not self.nolimit:
+                grow = max(min(grow, RESTRICTION_MAXTAPE - self.origin), -head)
+            self.tape[:0] = bytes(grow)
+            self.origin += grow
+            return head + grow
+        grow = max(len(self.tape), head + 1 - len(self.tape))
+        if not self.nolimit:
+            room = RESTRICTION_MAXTAPE - (len(self.tape) - 1 - self.origin)
+            grow = max(min(grow, room), head + 1 - len(self.tape))
+        self.tape += bytes(grow)
+        return head
 
-        self.ip += 1
+    def step(self):
+        # Runs one handler, i.e. possibly a whole block of straight-line
+        # code, not necessarily a single instruction.
+        (page_num, offset) = divmod(self.ip, PAGE_SIZE)
+        page = self.page_cache.get_compiled_page(page_num)
+        page.handlers[offset](self, page, offset)
+
+    def run(self):
+        # Same as calling step() forever, minus most of the lookups.
+        get_compiled_page = self.page_cache.get_compiled_page
+        frame = -PAGE_SIZE  # Start of the current page, in instructions
+        page = None
+        handlers = None
+        # Programs never end on their own, and may loop within one page
+        # forever, so pending output is checked for on a handler budget.
+        countdown = IO_FLUSH_CHECK_INTERVAL
+        while True:
+            offset = self.ip - frame
+            if not 0 <= offset < PAGE_SIZE:
+                (page_num, offset) = divmod(self.ip, PAGE_SIZE)
+                frame = page_num * PAGE_SIZE
+                page = get_compiled_page(page_num)
+                handlers = page.handlers
+            handlers[offset](self, page, offset)
+            countdown -= 1
+            if not countdown:
+                countdown = IO_FLUSH_CHECK_INTERVAL
+                self.iodev.flush_if_stale()
+
+
+def exit_on_signal(signum, frame):
+    # Raising SystemExit runs the atexit handlers, which flush the output.
+    exit(128 + signum)
 
 
 def run_machine(source_code, nolimit=False):
     seed = compute_seed(source_code)
+    signal.signal(signal.SIGTERM, exit_on_signal)
     m = Machine(source_code, seed, nolimit, iodev=DefaultIODev())
     if DEBUG_JUDECCA:
         # Print the first few "pages" to be nice.
         for i in range(10):
             print(prettify_instructions(m.page_cache.get_instructions(i)))
-    while True:
-        m.step()
+    m.run()
 
 
 def run_arbitrary(argv, nolimit=False):